@@ -20,6 +20,12 @@ import logging
 import asyncio
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:
+    # uvloop no está disponible en Windows: se usa el event loop estándar
+    uvloop = None
+
 # Importar servicios
 from services.prestashop_service import PrestaShopService
 from services.drive_service import DriveService
@@ -94,13 +100,18 @@ def main():
         prestashop_service = PrestaShopService(
             api_url=os.getenv("PRESTASHOP_API_URL"),
             username=os.getenv("PRESTASHOP_API_USERNAME"),
-            password=os.getenv("PRESTASHOP_API_PASSWORD", "")
+            password=os.getenv("PRESTASHOP_API_PASSWORD", ""),
+            use_lxml=os.getenv("PRESTASHOP_XML_PARSER", "lxml").lower() == "lxml",
+            order_fields=os.getenv("PRESTASHOP_ORDER_FIELDS", "").split(","),
+            customer_cache_file=os.getenv("PRESTASHOP_CUSTOMER_CACHE_FILE", ""),
+            bulk_state_updates=os.getenv("PRESTASHOP_BULK_STATE_UPDATES", "false").lower() == "true"
         )
 
         # Google Drive
         drive_service = DriveService(
             credentials_file=os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE"),
-            folder_id=os.getenv("GOOGLE_DRIVE_FOLDER_ID", "")
+            folder_id=os.getenv("GOOGLE_DRIVE_FOLDER_ID", ""),
+            use_folder_index=os.getenv("GOOGLE_DRIVE_FOLDER_INDEX", "false").lower() == "true"
         )
 
         # Google Sheets
@@ -137,12 +148,18 @@ def main():
             sheets_service=sheets_service,
             email_service=email_service,
             pdf_service=pdf_service,
-            notification_manager=notification_manager
+            notification_manager=notification_manager,
+            concurrency=int(os.getenv("INVOICE_CONCURRENCY", "8")),
+            order_timeout=float(os.getenv("INVOICE_ORDER_TIMEOUT", "120"))
         )
 
         logger.info("All services initialized successfully")
 
-        # Ejecutar proceso
+        # Ejecutar proceso (con uvloop si está instalado)
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("Using uvloop event loop")
+
         asyncio.run(processor.process_all_orders_async())
 
         logger.info("Process finished successfully")
@@ -2,33 +2,55 @@
 Servicio para interactuar con Google Drive
 Busca y descarga archivos JSON de facturas usando Service Account
 """
+import asyncio
 import io
 import logging
-from typing import Optional, Dict
+import threading
+import time
+from typing import Optional, Dict, List
 from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload, build_http
 from googleapiclient.errors import HttpError
 
 logger = logging.getLogger("ConfirmationInvoiceLogger")
 
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
+# Nombres por consulta en búsquedas múltiples (límite de longitud de la query)
+SEARCH_BATCH_SIZE = 50
+
+# Vigencia del índice en memoria de la carpeta, en segundos
+INDEX_TTL_SECONDS = 600
+
+
+def _escape_query_value(value: str) -> str:
+    """Escapa un valor para usarlo entre comillas simples en una query de Drive."""
+    return str(value).replace("\\", "\\\\").replace("'", "\\'")
+
 
 class DriveService:
     """Maneja operaciones con Google Drive usando Service Account"""
 
-    def __init__(self, credentials_file: str, folder_id: str = None):
+    def __init__(self, credentials_file: str, folder_id: str = None, use_folder_index: bool = False):
         """
         Inicializa el servicio de Google Drive.
 
         Args:
             credentials_file: Ruta al archivo de credenciales de Service Account
             folder_id: ID de la carpeta donde buscar archivos (opcional)
+            use_folder_index: Listar la carpeta completa en memoria en lugar de buscar
+                por nombre (solo compensa si la carpeta tiene pocos archivos)
         """
         self.service = None
         self.folder_id = folder_id
+        self.use_folder_index = use_folder_index
         self.credentials_file = credentials_file
+        self._credentials = None
+        self._local = threading.local()
+        self._index: Optional[Dict[str, Dict]] = None
+        self._index_loaded_at = 0.0
         self._authenticate()
 
     def _authenticate(self):
@@ -39,16 +61,91 @@ class DriveService:
                 scopes=SCOPES
             )
 
-            self.service = build('drive', 'v3', credentials=creds)
+            self._credentials = creds
+            self.service = build('drive', 'v3', credentials=creds, requestBuilder=self._build_request)
 
             # Validar conexión
             self.service.about().get(fields="user").execute()
             logger.info("✅ Google Drive Service authenticated successfully")
 
         except Exception as e:
-            logger.error(f"❌ Error authenticating with Google Drive: {str(e)}")
+            logger.error("❌ Error authenticating with Google Drive: %s", e)
             self.service = None
 
+    def _build_request(self, http, *args, **kwargs) -> HttpRequest:
+        """
+        Crea cada petición con un cliente HTTP propio del hilo actual.
+
+        httplib2 no es thread-safe, así que las descargas en paralelo
+        no pueden compartir la conexión creada por build().
+        """
+        thread_http = getattr(self._local, 'http', None)
+
+        if thread_http is None:
+            thread_http = AuthorizedHttp(self._credentials, http=build_http())
+            self._local.http = thread_http
+
+        return HttpRequest(thread_http, *args, **kwargs)
+
+    def refresh_index(self) -> bool:
+        """
+        Carga en memoria el listado completo de la carpeta (nombre -> archivo).
+
+        Con el índice cargado, las búsquedas por nombre no llaman a la API.
+        Requiere folder_id y use_folder_index; si no, se siguen usando consultas.
+
+        Returns:
+            True si el índice se cargó correctamente
+        """
+        if not self.service:
+            logger.error("Google Drive service not available")
+            return False
+
+        if not self.use_folder_index or not self.folder_id:
+            logger.debug("Drive folder index disabled, searching files by name")
+            return False
+
+        try:
+            index = {}
+            page_token = None
+
+            while True:
+                results = self.service.files().list(
+                    q=f"'{_escape_query_value(self.folder_id)}' in parents and trashed=false",
+                    spaces='drive',
+                    fields='nextPageToken, files(id, name, mimeType, modifiedTime, size)',
+                    pageSize=1000,
+                    pageToken=page_token
+                ).execute()
+
+                for file_info in results.get('files', []):
+                    index.setdefault(file_info['name'], file_info)
+
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+
+            self._index = index
+            self._index_loaded_at = time.monotonic()
+
+            logger.info("✅ Drive folder indexed (%s files)", len(index))
+            return True
+
+        except HttpError as e:
+            logger.error("❌ Error indexing Drive folder: %s", e)
+            return False
+
+    async def refresh_index_async(self) -> bool:
+        """Versión asíncrona de refresh_index, ejecutada en un hilo."""
+        return await asyncio.to_thread(self.refresh_index)
+
+    def _get_index(self) -> Optional[Dict[str, Dict]]:
+        """Devuelve el índice de la carpeta, recargándolo si ha caducado."""
+        if self._index is not None and time.monotonic() - self._index_loaded_at > INDEX_TTL_SECONDS:
+            self.refresh_index()
+
+        return self._index
+
     def search_file_by_name(self, file_name: str) -> Optional[Dict]:
         """
         Busca un archivo por nombre en la carpeta especificada.
@@ -63,16 +160,20 @@ class DriveService:
             logger.error("Google Drive service not available")
             return None
 
+        index = self._get_index()
+        if index is not None:
+            return index.get(file_name)
+
         try:
             # Construir query
-            query_parts = [f"name='{file_name}'", "trashed=false"]
+            query_parts = [f"name='{_escape_query_value(file_name)}'", "trashed=false"]
 
             if self.folder_id:
-                query_parts.append(f"'{self.folder_id}' in parents")
+                query_parts.append(f"'{_escape_query_value(self.folder_id)}' in parents")
 
             query = " and ".join(query_parts)
 
-            logger.debug(f"Searching for file: {file_name}")
+            logger.debug("Searching for file: %s", file_name)
 
             results = self.service.files().list(
                 q=query,
@@ -84,16 +185,80 @@ class DriveService:
             files = results.get('files', [])
 
             if files:
-                logger.info(f"✅ File found in Drive: {file_name}")
+                logger.info("✅ File found in Drive: %s", file_name)
                 return files[0]
             else:
-                logger.debug(f"File not found in Drive: {file_name}")
+                logger.debug("File not found in Drive: %s", file_name)
                 return None
 
         except HttpError as e:
-            logger.error(f"❌ Error searching file in Drive: {str(e)}")
+            logger.error("❌ Error searching file in Drive: %s", e)
             return None
 
+    def search_files_by_names(self, file_names: List[str]) -> Dict[str, Dict]:
+        """
+        Busca varios archivos por nombre con el mínimo de llamadas a la API.
+
+        Los nombres se agrupan en consultas de SEARCH_BATCH_SIZE para no
+        superar el límite de longitud de la query de Drive.
+
+        Args:
+            file_names: Nombres de los archivos a buscar
+
+        Returns:
+            Diccionario nombre -> información del archivo (solo los encontrados)
+        """
+        if not self.service:
+            logger.error("Google Drive service not available")
+            return {}
+
+        index = self._get_index()
+        if index is not None:
+            return {name: index[name] for name in file_names if name in index}
+
+        found = {}
+        unique_names = list(dict.fromkeys(file_names))
+
+        try:
+            for start in range(0, len(unique_names), SEARCH_BATCH_SIZE):
+                batch = unique_names[start:start + SEARCH_BATCH_SIZE]
+                names_query = " or ".join(f"name='{_escape_query_value(name)}'" for name in batch)
+                query_parts = [f"({names_query})", "trashed=false"]
+
+                if self.folder_id:
+                    query_parts.append(f"'{_escape_query_value(self.folder_id)}' in parents")
+
+                query = " and ".join(query_parts)
+                page_token = None
+
+                while True:
+                    results = self.service.files().list(
+                        q=query,
+                        spaces='drive',
+                        fields='nextPageToken, files(id, name, mimeType, modifiedTime, size)',
+                        pageSize=1000,
+                        pageToken=page_token
+                    ).execute()
+
+                    for file_info in results.get('files', []):
+                        # Conservar el primer resultado, igual que search_file_by_name
+                        found.setdefault(file_info['name'], file_info)
+
+                    page_token = results.get('nextPageToken')
+                    if not page_token:
+                        break
+
+            logger.info("✅ Found %s/%s files in Drive", len(found), len(unique_names))
+            return found
+
+        except HttpError as e:
+            logger.error("❌ Error searching files in Drive: %s", e)
+            return found
+
+    async def search_files_by_names_async(self, file_names: List[str]) -> Dict[str, Dict]:
+        """Versión asíncrona de search_files_by_names, ejecutada en un hilo."""
+        return await asyncio.to_thread(self.search_files_by_names, file_names)
+
     def download_file(self, file_id: str) -> Optional[bytes]:
         """
         Descarga un archivo desde Google Drive.
@@ -109,7 +274,7 @@ class DriveService:
             return None
 
         try:
-            logger.debug(f"Downloading file: {file_id}")
+            logger.debug("Downloading file: %s", file_id)
 
             request = self.service.files().get_media(fileId=file_id)
             file_buffer = io.BytesIO()
@@ -122,13 +287,45 @@ class DriveService:
             file_buffer.seek(0)
             content = file_buffer.read()
 
-            logger.info(f"✅ File downloaded successfully ({len(content)} bytes)")
+            logger.info("✅ File downloaded successfully (%s bytes)", len(content))
             return content
 
         except HttpError as e:
-            logger.error(f"❌ Error downloading file from Drive: {str(e)}")
+            logger.error("❌ Error downloading file from Drive: %s", e)
             return None
 
+    async def download_file_async(self, file_id: str) -> Optional[bytes]:
+        """Versión asíncrona de download_file, ejecutada en un hilo."""
+        return await asyncio.to_thread(self.download_file, file_id)
+
+    async def download_files(self, file_ids: List[str]) -> Dict[str, bytes]:
+        """
+        Descarga varios archivos en paralelo, cada uno en un hilo.
+
+        Args:
+            file_ids: IDs de los archivos en Google Drive
+
+        Returns:
+            Diccionario id -> contenido (solo las descargas correctas)
+        """
+        unique_ids = list(dict.fromkeys(file_ids))
+
+        results = await asyncio.gather(
+            *(self.download_file_async(file_id) for file_id in unique_ids),
+            return_exceptions=True
+        )
+
+        contents = {}
+
+        for file_id, result in zip(unique_ids, results):
+            if isinstance(result, Exception):
+                logger.error("❌ Error downloading file %s from Drive: %s", file_id, result)
+            elif result is not None:
+                contents[file_id] = result
+
+        logger.info("✅ Downloaded %s/%s files from Drive", len(contents), len(unique_ids))
+        return contents
+
     def download_file_by_name(self, file_name: str) -> Optional[bytes]:
         """
         Busca y descarga un archivo por su nombre.
@@ -142,7 +339,7 @@ class DriveService:
         file_info = self.search_file_by_name(file_name)
 
         if not file_info:
-            logger.warning(f"Cannot download file '{file_name}': not found")
+            logger.warning("Cannot download file '%s': not found", file_name)
             return None
 
         return self.download_file(file_info['id'])
@@ -2,17 +2,18 @@
 Servicio para envío de emails con facturas
 Usa SMTP Office365 y plantillas HTML desde API
 """
+import asyncio
 import aiosmtplib
 import aiohttp
 import logging
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+from email.message import EmailMessage
 from typing import Optional, Dict, Any
 
 logger = logging.getLogger("ConfirmationInvoiceLogger")
 
+# Conexiones simultáneas máximas del pool HTTP
+HTTP_POOL_LIMIT = 32
+
 
 class EmailService:
     """Maneja el envío de emails con facturas a clientes"""
@@ -49,8 +50,85 @@ class EmailService:
         self.bcc_email = bcc_email
         self.environment = environment
         self.dev_test_email = dev_test_email
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.smtp: Optional[aiosmtplib.SMTP] = None
+        self._smtp_lock: Optional[asyncio.Lock] = None
+
+        logger.info("Email Service initialized (environment: %s)", environment)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Devuelve la sesión HTTP compartida, creándola en el primer uso."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, ttl_dns_cache=300)
+            )
+        return self._session
+
+    async def connect(self):
+        """Abre la conexión SMTP persistente (STARTTLS + login) usada para todos los envíos."""
+        if self.smtp is not None:
+            self.smtp.close()
+
+        self.smtp = aiosmtplib.SMTP(
+            hostname=self.smtp_server,
+            port=self.smtp_port,
+            start_tls=True,
+            timeout=60
+        )
+        try:
+            await self.smtp.connect()
+            await self.smtp.login(self.sender_email, self.sender_password)
+        except BaseException:
+            # Sin login completo la conexión no sirve: descartarla para que el
+            # siguiente envío vuelva a conectar (también si se cancela el login)
+            self.smtp.close()
+            self.smtp = None
+            raise
+
+        logger.info("SMTP connection opened to %s:%s", self.smtp_server, self.smtp_port)
+
+    async def _send_message(self, message: EmailMessage):
+        """
+        Envía un mensaje por la conexión SMTP persistente.
 
-        logger.info(f"Email Service initialized (environment: {environment})")
+        Los envíos se serializan (SMTP es secuencial) y, si el servidor ha
+        cerrado la conexión, se reconecta y se reintenta una vez.
+        """
+        if self._smtp_lock is None:
+            self._smtp_lock = asyncio.Lock()
+
+        async with self._smtp_lock:
+            if self.smtp is None or not self.smtp.is_connected:
+                await self.connect()
+
+            try:
+                await self._send_or_close(message)
+            except aiosmtplib.SMTPServerDisconnected:
+                logger.warning("SMTP connection lost, reconnecting")
+                await self.connect()
+                await self._send_or_close(message)
+
+    async def _send_or_close(self, message: EmailMessage):
+        """Envía el mensaje y cierra la conexión SMTP si el envío se cancela."""
+        try:
+            await self.smtp.send_message(message)
+        except asyncio.CancelledError:
+            # Un envío interrumpido deja la sesión SMTP en un estado incierto
+            self.smtp.close()
+            raise
+
+    async def close(self):
+        """Cierra la sesión HTTP y la conexión SMTP."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+        if self.smtp is not None and self.smtp.is_connected:
+            try:
+                await self.smtp.quit()
+            except aiosmtplib.SMTPException:
+                self.smtp.close()
+        self.smtp = None
 
     async def generate_email_template(
         self,
@@ -69,8 +147,10 @@ class EmailService:
         Returns:
             Dict con 'html' y otros datos del template, None si hay error
         """
+        order_reference = order_data.get('reference', 'N/A')
+
         try:
-            logger.debug(f"Generating email template for order {order_data.get('reference', 'N/A')}")
+            logger.debug("[%s] Generating email template", order_reference)
 
             payload = {
                 "order": order_data,
@@ -78,25 +158,68 @@ class EmailService:
                 "address": address_data
             }
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.template_api_url,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info("✅ Email template generated successfully")
-                        return result.get('body', {})
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Error generating email template: {response.status} - {error_text}")
-                        return None
+            session = self._get_session()
+
+            async with session.post(
+                self.template_api_url,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    logger.info("[%s] ✅ Email template generated successfully", order_reference)
+                    return result.get('body', {})
+                else:
+                    error_text = await response.text()
+                    logger.error(
+                        "[%s] Error generating email template: %s - %s", order_reference, response.status, error_text
+                    )
+                    return None
 
         except Exception as e:
-            logger.error(f"Failed to generate email template: {e}")
+            logger.error("[%s] Failed to generate email template: %s", order_reference, e)
             return None
 
+    def _build_message(
+        self,
+        recipient_email: str,
+        subject: str,
+        html_body: str,
+        pdf_content: bytes,
+        pdf_filename: str
+    ) -> EmailMessage:
+        """
+        Construye el mensaje con el cuerpo HTML y la factura PDF adjunta.
+
+        Args:
+            recipient_email: Email del destinatario
+            subject: Asunto del email
+            html_body: Contenido HTML del email
+            pdf_content: Contenido del PDF en bytes
+            pdf_filename: Nombre del archivo PDF
+
+        Returns:
+            Mensaje listo para enviar
+        """
+        message = EmailMessage()
+        message["From"] = self.sender_email
+        message["To"] = recipient_email
+        message["Subject"] = subject
+
+        # Añadir BCC si está configurado
+        if self.bcc_email and self.environment == "production":
+            message["Bcc"] = self.bcc_email
+
+        message.set_content(html_body, subtype="html", charset="utf-8")
+        message.add_attachment(
+            pdf_content,
+            maintype="application",
+            subtype="pdf",
+            filename=pdf_filename
+        )
+
+        return message
+
     async def send_invoice_email(
         self,
         recipient_email: str,
@@ -122,51 +245,27 @@ class EmailService:
             # En modo desarrollo, redirigir al email de prueba
             original_recipient = recipient_email
             if self.environment == "development" and self.dev_test_email:
-                logger.info(f"🔧 DEV MODE: Redirecting email from {recipient_email} to {self.dev_test_email}")
+                logger.info("🔧 DEV MODE: Redirecting email from %s to %s", recipient_email, self.dev_test_email)
                 recipient_email = self.dev_test_email
 
-            # Crear mensaje
-            message = MIMEMultipart("alternative")
-            message["From"] = self.sender_email
-            message["To"] = recipient_email
-            message["Subject"] = subject
-
-            # Añadir BCC si está configurado
-            if self.bcc_email and self.environment == "production":
-                message["Bcc"] = self.bcc_email
-
-            # Adjuntar contenido HTML
-            html_part = MIMEText(html_body, "html", "utf-8")
-            message.attach(html_part)
-
-            # Adjuntar PDF
-            pdf_part = MIMEBase("application", "pdf")
-            pdf_part.set_payload(pdf_content)
-            encoders.encode_base64(pdf_part)
-            pdf_part.add_header(
-                "Content-Disposition",
-                f"attachment; filename={pdf_filename}"
+            message = self._build_message(
+                recipient_email=recipient_email,
+                subject=subject,
+                html_body=html_body,
+                pdf_content=pdf_content,
+                pdf_filename=pdf_filename
             )
-            message.attach(pdf_part)
 
             # Enviar email
-            logger.info(f"Sending invoice email to {recipient_email}")
-
-            await aiosmtplib.send(
-                message,
-                hostname=self.smtp_server,
-                port=self.smtp_port,
-                start_tls=True,
-                username=self.sender_email,
-                password=self.sender_password,
-                timeout=60
-            )
+            logger.info("Sending invoice email to %s", recipient_email)
 
-            logger.info(f"✅ Invoice email sent successfully to {original_recipient}")
+            await self._send_message(message)
+
+            logger.info("✅ Invoice email sent successfully to %s", original_recipient)
             return True
 
         except Exception as e:
-            logger.error(f"❌ Failed to send invoice email: {e}")
+            logger.error("❌ Failed to send invoice email: %s", e)
             return False
 
     async def send_invoice_with_template(
@@ -190,21 +289,22 @@ class EmailService:
         Returns:
             True si el email se envió correctamente
         """
+        order_reference = order_data.get('reference', 'N/A')
+
         try:
             # Generar plantilla
             template = await self.generate_email_template(order_data, customer_data, address_data)
 
             if not template or 'html' not in template:
-                logger.error("Cannot send email: template generation failed")
+                logger.error("[%s] Cannot send email: template generation failed", order_reference)
                 return False
 
             # Preparar datos del email
             recipient_email = customer_data.get('email')
             if not recipient_email:
-                logger.error("Cannot send email: no recipient email")
+                logger.error("[%s] Cannot send email: no recipient email", order_reference)
                 return False
 
-            order_reference = order_data.get('reference', 'N/A')
             subject = f"Factura de tu pedido {order_reference}"
 
             customer_name = customer_data.get('firstname', 'Cliente')
@@ -220,5 +320,5 @@ class EmailService:
             )
 
         except Exception as e:
-            logger.error(f"Failed to send invoice with template: {e}")
+            logger.error("[%s] Failed to send invoice with template: %s", order_reference, e)
             return False
@@ -3,11 +3,12 @@ Procesador principal de facturas
 Orquesta el flujo completo: obtener pedidos, procesar facturas y enviar emails
 """
 import asyncio
-import json
 import logging
-from typing import Dict, Any, Optional
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, NamedTuple, Optional
 
-from services.prestashop_service import PrestaShopService
+from services.prestashop_service import PrestaShopService, get_customer_url
 from services.drive_service import DriveService
 from services.sheets_service import SheetsService
 from services.email_service import EmailService
@@ -16,6 +17,36 @@ from services.notifications import NotificationManager
 
 logger = logging.getLogger("ConfirmationInvoiceLogger")
 
+# Hilos disponibles para las llamadas bloqueantes (Google APIs, PrestaShop)
+THREAD_POOL_WORKERS = 16
+
+# Estado de PrestaShop "Factura enviada"
+INVOICE_SENT_STATE_ID = 23
+
+# Nombre del archivo JSON de factura en Drive para una referencia de pedido
+INVOICE_FILE_NAME = "factura_{}.json".format
+
+
+class InvoiceView(NamedTuple):
+    """Campos de la factura usados en el proceso, extraídos una sola vez del JSON."""
+    customer: Optional[str]
+    postcode: Optional[str]
+    city: Optional[str]
+    num_invoice: str
+    invoice_id: str
+
+
+def _invoice_view(invoice_details: Dict[str, Any]) -> InvoiceView:
+    """Construye la vista de la factura a partir del bloque 'data' del JSON."""
+    get = invoice_details.get
+    return InvoiceView(
+        customer=get('cliente'),
+        postcode=get('cod_postal'),
+        city=get('ciudad'),
+        num_invoice=f"{get('num_factura')}-{get('año_factura')}",
+        invoice_id=get('id', '')
+    )
+
 
 class InvoiceProcessor:
     """Procesa pedidos y envía facturas"""
@@ -27,7 +58,9 @@ class InvoiceProcessor:
         sheets_service: SheetsService,
         email_service: EmailService,
         pdf_service: PDFService,
-        notification_manager: NotificationManager
+        notification_manager: NotificationManager,
+        concurrency: int = 8,
+        order_timeout: float = 120
     ):
         """
         Inicializa el procesador de facturas.
@@ -39,6 +72,8 @@ class InvoiceProcessor:
             email_service: Servicio de email
             pdf_service: Servicio de generación de PDF
             notification_manager: Gestor de notificaciones
+            concurrency: Número máximo de pedidos procesados en paralelo
+            order_timeout: Tiempo máximo en segundos para procesar un pedido
         """
         self.prestashop = prestashop_service
         self.drive = drive_service
@@ -46,12 +81,18 @@ class InvoiceProcessor:
         self.email = email_service
         self.pdf = pdf_service
         self.notifications = notification_manager
+        self.concurrency = max(1, concurrency)
+        self.order_timeout = order_timeout
 
         self.processed_count = 0
         self.success_count = 0
         self.error_count = 0
         self.skipped_count = 0
 
+        # Pedidos cuyo estado se actualiza en PrestaShop al final del proceso
+        # (solo con el envío en bloque de cambios de estado activado)
+        self._state_updates: List[str] = []
+
     async def process_all_orders_async(self):
         """Procesa todos los pedidos pendientes de factura."""
         try:
@@ -59,8 +100,16 @@ class InvoiceProcessor:
             logger.info("STARTING INVOICE CONFIRMATION PROCESS")
             logger.info("=" * 60)
 
+            # Todas las facturas de esta ejecución se registran con la misma fecha
+            self.sheets.begin_run()
+
+            # Las llamadas síncronas se ejecutan en este pool fuera del event loop
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS)
+            )
+
             # Obtener pedidos pendientes
-            orders = self.prestashop.get_orders_pending_invoice()
+            orders = await asyncio.to_thread(self.prestashop.get_orders_pending_invoice)
 
             if not orders:
                 logger.info("No orders pending invoice confirmation")
@@ -70,19 +119,68 @@ class InvoiceProcessor:
                 )
                 return
 
-            logger.info(f"Found {len(orders)} orders to process")
+            logger.info("Found %s orders to process (concurrency: %s)", len(orders), self.concurrency)
+
+            # Indexar la carpeta de Drive si está activado (si no, se busca por nombre)
+            await self.drive.refresh_index_async()
+
+            # Buscar todas las facturas JSON (en el índice o con consultas agrupadas)
+            invoice_file_names = [INVOICE_FILE_NAME(order.get('reference')) for order in orders]
+            invoice_files = await self.drive.search_files_by_names_async(invoice_file_names)
+
+            # Separar los pedidos sin factura: se omiten sin lanzar su tarea
+            present = []
+            missing = []
+
+            for order, invoice_file_name in zip(orders, invoice_file_names):
+                invoice_file = invoice_files.get(invoice_file_name)
+
+                if invoice_file:
+                    present.append((order, invoice_file))
+                else:
+                    missing.append(str(order.get('reference')))
+
+            if missing:
+                logger.warning("Invoice file not found for %s orders, skipping: %s", len(missing), ', '.join(missing))
+                self.processed_count += len(missing)
+                self.skipped_count += len(missing)
 
-            # Procesar cada pedido
-            for order in orders:
-                await self.process_single_order(order)
+            # Descargar las facturas y obtener los clientes de los pedidos a la vez
+            invoice_contents, customers = await asyncio.gather(
+                self.drive.download_files([invoice_file['id'] for _, invoice_file in present]),
+                self.prestashop.get_customers_bulk_async([get_customer_url(order) for order, _ in present])
+            )
+
+            # Procesar pedidos en paralelo, limitado por el semáforo
+            semaphore = asyncio.Semaphore(self.concurrency)
+            await asyncio.gather(
+                *(
+                    self._process_with_semaphore(
+                        semaphore,
+                        order,
+                        invoice_file,
+                        invoice_contents.get(invoice_file['id']),
+                        customers.get(get_customer_url(order))
+                    )
+                    for order, invoice_file in present
+                )
+            )
+
+            # Actualizar el estado de todos los pedidos enviados
+            await self._flush_state_updates()
+
+            # Registrar todas las facturas enviadas en Google Sheets de una vez
+            if self.success_count:
+                logger.info("Logging %s invoices to Google Sheets", self.success_count)
+                await self.sheets.flush_pending_invoices_async()
 
             # Resumen final
             logger.info("=" * 60)
             logger.info("PROCESS COMPLETED")
-            logger.info(f"Total processed: {self.processed_count}")
-            logger.info(f"Success: {self.success_count}")
-            logger.info(f"Errors: {self.error_count}")
-            logger.info(f"Skipped: {self.skipped_count}")
+            logger.info("Total processed: %s", self.processed_count)
+            logger.info("Success: %s", self.success_count)
+            logger.info("Errors: %s", self.error_count)
+            logger.info("Skipped: %s", self.skipped_count)
             logger.info("=" * 60)
 
             # Notificar resumen
@@ -105,133 +203,208 @@ class InvoiceProcessor:
                 )
 
         except Exception as e:
-            logger.error(f"Critical error in process: {e}", exc_info=True)
+            logger.error("Critical error in process: %s", e, exc_info=True)
             await self.notifications.notify_critical_error(
                 "Error crítico en confirmación de facturas",
                 f"El proceso falló: {str(e)}",
                 {"exception": str(e)}
             )
 
-    async def process_single_order(self, order: Dict[str, Any]):
+        finally:
+            # Los pedidos ya enviados por email pasan siempre a "Factura enviada",
+            # aunque el proceso se haya interrumpido, para no reenviarlos
+            try:
+                await self._flush_state_updates()
+            except Exception as e:
+                logger.error("Error updating pending order states: %s", e, exc_info=True)
+
+            # Escribir los registros de Sheets pendientes, guardar la caché de clientes
+            # y cerrar las conexiones HTTP
+            await asyncio.to_thread(self.sheets.close)
+            await asyncio.to_thread(self.prestashop.close)
+            await self.pdf.close()
+            await self.email.close()
+
+    async def _flush_state_updates(self):
+        """Actualiza en PrestaShop el estado de los pedidos enviados y vacía la cola."""
+        if not self._state_updates:
+            return
+
+        order_ids, self._state_updates = self._state_updates, []
+
+        logger.info("Updating state of %s orders in PrestaShop", len(order_ids))
+        state_results = await self.prestashop.update_order_states_bulk_async(
+            [(order_id, INVOICE_SENT_STATE_ID) for order_id in order_ids]
+        )
+
+        failed = [order_id for order_id, updated in state_results.items() if not updated]
+        if failed:
+            logger.warning("Failed to update order state (non-critical): %s", ', '.join(failed))
+
+    async def _process_with_semaphore(
+        self,
+        semaphore: asyncio.Semaphore,
+        order: Dict[str, Any],
+        invoice_file: Dict,
+        invoice_content: Optional[bytes],
+        customer_data: Optional[Dict]
+    ):
+        """Procesa un pedido respetando el límite de concurrencia."""
+        async with semaphore:
+            await self.process_single_order(order, invoice_file, invoice_content, customer_data)
+
+    async def process_single_order(
+        self,
+        order: Dict[str, Any],
+        invoice_file: Dict,
+        invoice_content: Optional[bytes],
+        customer_data: Optional[Dict]
+    ):
         """
         Procesa un solo pedido.
 
         Args:
             order: Datos del pedido de PrestaShop
+            invoice_file: Información del archivo de factura en Drive
+            invoice_content: Contenido descargado de la factura, None si la descarga falló
+            customer_data: Datos del cliente obtenidos previamente, None si la consulta falló
         """
         order_id = order.get('id')
         order_reference = order.get('reference')
 
-        logger.info(f"\n{'=' * 60}")
-        logger.info(f"Processing order {order_reference} (ID: {order_id})")
-        logger.info(f"{'=' * 60}")
+        logger.info("[%s] Processing order (ID: %s)", order_reference, order_id)
 
+        # Los contadores solo se modifican desde el event loop y sin await
+        # intermedio, por lo que los incrementos son atómicos entre tareas
         self.processed_count += 1
 
         try:
-            # 1. Buscar factura JSON en Google Drive
-            invoice_file_name = f"factura_{order_reference}.json"
-            logger.info(f"[1/7] Searching for invoice file: {invoice_file_name}")
+            # Pasos 1-5 limitados por order_timeout; si se supera se cancelan y el
+            # pedido falla como cualquier otro error (la notificación queda fuera)
+            try:
+                invoice = await asyncio.wait_for(
+                    self._send_order_invoice(order, invoice_file, invoice_content, customer_data),
+                    timeout=self.order_timeout
+                )
+            except asyncio.TimeoutError:
+                raise Exception(
+                    f"Tiempo máximo de procesamiento superado ({self.order_timeout}s)"
+                ) from None
+
+            # 6. Actualizar el estado del pedido en PrestaShop (con envío en bloque
+            #    activado se encola y se envía al final del proceso)
+            if self.prestashop.bulk_state_updates:
+                logger.info("[%s] [6/7] Queueing order state update", order_reference)
+                self._state_updates.append(str(order_id))
+            else:
+                logger.info("[%s] [6/7] Updating order state in PrestaShop", order_reference)
+                state_updated = await asyncio.to_thread(
+                    self.prestashop.update_order_state, order_id, INVOICE_SENT_STATE_ID
+                )
 
-            invoice_file = self.drive.search_file_by_name(invoice_file_name)
+                if not state_updated:
+                    logger.warning("[%s] Failed to update order state (non-critical)", order_reference)
 
-            if not invoice_file:
-                logger.warning(f"Invoice file not found for order {order_reference}, skipping")
-                self.skipped_count += 1
-                return
+            # 7. Encolar el registro en Google Sheets (se escribe al final del proceso)
+            logger.info("[%s] [7/7] Queueing Google Sheets record", order_reference)
+            self.sheets.append_or_update_invoice(order_reference, invoice.invoice_id, invoice.num_invoice)
 
-            logger.info(f"✅ Invoice file found: {invoice_file['name']}")
+            # Éxito
+            self.success_count += 1
+            logger.info("[%s] ✅ Order processed successfully", order_reference)
 
-            # 2. Descargar archivo JSON
-            logger.info(f"[2/7] Downloading invoice JSON file")
-            invoice_json_content = self.drive.download_file(invoice_file['id'])
+        except Exception as e:
+            self.error_count += 1
+            logger.error("[%s] ❌ Error processing order: %s", order_reference, e, exc_info=True)
 
-            if not invoice_json_content:
-                raise Exception("Failed to download invoice JSON file")
+            # Notificar error
+            await self.notifications.notify_warning(
+                f"Error procesando pedido {order_reference}",
+                str(e),
+                {
+                    "order_id": order_id,
+                    "order_reference": order_reference,
+                    "error": str(e)
+                }
+            )
 
-            # Parsear JSON
-            invoice_data = json.loads(invoice_json_content.decode('utf-8'))
-            invoice_details = invoice_data.get('data', {})
+    async def _send_order_invoice(
+        self,
+        order: Dict[str, Any],
+        invoice_file: Dict,
+        invoice_content: Optional[bytes],
+        customer_data: Optional[Dict]
+    ) -> InvoiceView:
+        """
+        Genera el PDF de la factura y la envía por email al cliente (pasos 1-5).
 
-            logger.info(f"✅ Invoice JSON loaded: {invoice_details.get('num_factura')}-{invoice_details.get('año_factura')}")
+        Args:
+            order: Datos del pedido de PrestaShop
+            invoice_file: Información del archivo de factura en Drive
+            invoice_content: Contenido descargado de la factura, None si la descarga falló
+            customer_data: Datos del cliente obtenidos previamente, None si la consulta falló
 
-            # 3. Obtener datos del cliente
-            logger.info(f"[3/7] Fetching customer data")
-            customer_url = order.get('id_customer', {}).get('@xlink:href')
+        Returns:
+            Vista de la factura enviada (lanza una excepción si algún paso falla)
+        """
+        order_reference = order.get('reference')
 
-            if not customer_url:
-                raise Exception("Customer URL not found in order")
+        # 1. Factura JSON localizada previamente en Google Drive
+        logger.info("[%s] [1/7] Invoice file found: %s", order_reference, invoice_file['name'])
 
-            customer_data = self.prestashop.get_customer_data(customer_url)
+        # 2. Obtener archivo JSON (descargado previamente)
+        logger.info("[%s] [2/7] Loading downloaded invoice JSON file", order_reference)
 
-            if not customer_data:
-                raise Exception("Failed to fetch customer data")
+        if not invoice_content:
+            raise Exception("Failed to download invoice JSON file")
 
-            logger.info(f"✅ Customer data loaded: {customer_data.get('email')}")
+        # Parsear JSON (orjson trabaja directamente sobre los bytes)
+        invoice_data = orjson.loads(invoice_content)
+        invoice_details = invoice_data.get('data', {})
+        invoice = _invoice_view(invoice_details)
 
-            # 4. Preparar datos de dirección
-            logger.info(f"[4/7] Preparing address data")
-            address_data = {
-                'customer': invoice_details.get('cliente'),
-                'postcode': invoice_details.get('cod_postal'),
-                'city': invoice_details.get('ciudad'),
-                'num_invoice': f"{invoice_details.get('num_factura')}-{invoice_details.get('año_factura')}"
-            }
+        logger.info("[%s] ✅ Invoice JSON loaded: %s", order_reference, invoice.num_invoice)
 
-            # 5. Generar PDF
-            logger.info(f"[5/7] Generating invoice PDF")
-            pdf_content = await self.pdf.generate_invoice_pdf(invoice_details)
+        # 3. Comprobar los datos del cliente (obtenidos previamente) y generar el PDF
+        logger.info("[%s] [3/7] Checking customer data and generating invoice PDF", order_reference)
 
-            if not pdf_content:
-                raise Exception("Failed to generate PDF")
+        if not get_customer_url(order):
+            raise Exception("Customer URL not found in order")
 
-            logger.info(f"✅ PDF generated successfully")
+        if not customer_data:
+            raise Exception("Failed to fetch customer data")
 
-            # 6. Enviar email
-            logger.info(f"[6/7] Sending invoice email")
-            email_sent = await self.email.send_invoice_with_template(
-                order_data=order,
-                customer_data=customer_data,
-                address_data=address_data,
-                pdf_content=pdf_content,
-                invoice_number=address_data['num_invoice']
-            )
+        logger.info("[%s] ✅ Customer data loaded: %s", order_reference, customer_data.get('email'))
 
-            if not email_sent:
-                raise Exception("Failed to send invoice email")
+        pdf_content = await self.pdf.generate_invoice_pdf(invoice_details)
 
-            logger.info(f"✅ Invoice email sent successfully")
+        if not pdf_content:
+            raise Exception("Failed to generate PDF")
 
-            # 7. Actualizar estado del pedido en PrestaShop
-            logger.info(f"[7/7] Updating order state in PrestaShop")
-            state_updated = self.prestashop.update_order_state(order_id, new_state_id=23)
+        logger.info("[%s] ✅ PDF generated successfully", order_reference)
 
-            if not state_updated:
-                logger.warning("Failed to update order state (non-critical)")
+        # 4. Preparar datos de dirección
+        logger.info("[%s] [4/7] Preparing address data", order_reference)
+        address_data = {
+            'customer': invoice.customer,
+            'postcode': invoice.postcode,
+            'city': invoice.city,
+            'num_invoice': invoice.num_invoice
+        }
 
-            # 8. Registrar en Google Sheets
-            logger.info(f"[8/8] Logging to Google Sheets")
-            self.sheets.append_or_update_invoice(
-                reference=order_reference,
-                invoice_id=invoice_details.get('id', ''),
-                invoice_number=address_data['num_invoice']
-            )
+        # 5. Enviar email
+        logger.info("[%s] [5/7] Sending invoice email", order_reference)
+        email_sent = await self.email.send_invoice_with_template(
+            order_data=order,
+            customer_data=customer_data,
+            address_data=address_data,
+            pdf_content=pdf_content,
+            invoice_number=invoice.num_invoice
+        )
 
-            # Éxito
-            self.success_count += 1
-            logger.info(f"✅ Order {order_reference} processed successfully")
+        if not email_sent:
+            raise Exception("Failed to send invoice email")
 
-        except Exception as e:
-            self.error_count += 1
-            logger.error(f"❌ Error processing order {order_reference}: {e}", exc_info=True)
+        logger.info("[%s] ✅ Invoice email sent successfully", order_reference)
 
-            # Notificar error
-            await self.notifications.notify_warning(
-                f"Error procesando pedido {order_reference}",
-                str(e),
-                {
-                    "order_id": order_id,
-                    "order_reference": order_reference,
-                    "error": str(e)
-                }
-            )
+        return invoice
@@ -3,11 +3,18 @@ Servicio para generación de PDFs de facturas
 Usa una API externa para convertir datos a PDF
 """
 import aiohttp
+import base64
 import logging
 from typing import Optional, Dict, Any
 
 logger = logging.getLogger("ConfirmationInvoiceLogger")
 
+# Conexiones simultáneas máximas del pool HTTP
+HTTP_POOL_LIMIT = 32
+
+# Se prefiere el PDF binario; el JSON con base64 queda como alternativa
+PDF_ACCEPT_HEADER = "application/pdf, application/json;q=0.9"
+
 
 class PDFService:
     """Maneja la generación de PDFs de facturas"""
@@ -20,8 +27,23 @@ class PDFService:
             pdf_api_url: URL de la API para generar PDFs
         """
         self.pdf_api_url = pdf_api_url
+        self._session: Optional[aiohttp.ClientSession] = None
         logger.info("PDF Service initialized")
 
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Devuelve la sesión HTTP compartida, creándola en el primer uso."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, ttl_dns_cache=300)
+            )
+        return self._session
+
+    async def close(self):
+        """Cierra la sesión HTTP."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
     async def generate_invoice_pdf(self, invoice_data: Dict[str, Any]) -> Optional[bytes]:
         """
         Genera un PDF de factura desde los datos proporcionados.
@@ -32,38 +54,47 @@ class PDFService:
         Returns:
             Contenido del PDF en bytes, None si hay error
         """
+        invoice_number = invoice_data.get('num_factura', 'N/A')
+
         try:
-            logger.debug(f"Generating PDF for invoice {invoice_data.get('num_factura', 'N/A')}")
+            logger.debug("[%s] Generating PDF for invoice", invoice_number)
 
             payload = {
                 "data": invoice_data
             }
 
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.pdf_api_url,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=60)
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-
-                        # La API retorna el PDF en base64 dentro de body.pdf
-                        if 'body' in result and 'pdf' in result['body']:
-                            import base64
-                            pdf_base64 = result['body']['pdf']
-                            pdf_bytes = base64.b64decode(pdf_base64)
-
-                            logger.info(f"✅ PDF generated successfully ({len(pdf_bytes)} bytes)")
-                            return pdf_bytes
-                        else:
-                            logger.error("PDF generation response missing 'body.pdf' field")
-                            return None
+            session = self._get_session()
+
+            async with session.post(
+                self.pdf_api_url,
+                json=payload,
+                headers={"Accept": PDF_ACCEPT_HEADER},
+                timeout=aiohttp.ClientTimeout(total=60)
+            ) as response:
+                if response.status == 200 and response.content_type == 'application/pdf':
+                    # La API devuelve el PDF directamente, sin JSON ni base64
+                    pdf_bytes = await response.read()
+
+                    logger.info("[%s] ✅ PDF generated successfully (%s bytes)", invoice_number, len(pdf_bytes))
+                    return pdf_bytes
+                elif response.status == 200:
+                    result = await response.json()
+
+                    # La API retorna el PDF en base64 dentro de body.pdf
+                    if 'body' in result and 'pdf' in result['body']:
+                        pdf_base64 = result['body']['pdf']
+                        pdf_bytes = base64.b64decode(pdf_base64)
+
+                        logger.info("[%s] ✅ PDF generated successfully (%s bytes)", invoice_number, len(pdf_bytes))
+                        return pdf_bytes
                     else:
-                        error_text = await response.text()
-                        logger.error(f"Error generating PDF: {response.status} - {error_text}")
+                        logger.error("[%s] PDF generation response missing 'body.pdf' field", invoice_number)
                         return None
+                else:
+                    error_text = await response.text()
+                    logger.error("[%s] Error generating PDF: %s - %s", invoice_number, response.status, error_text)
+                    return None
 
         except Exception as e:
-            logger.error(f"Failed to generate PDF: {e}")
+            logger.error("[%s] Failed to generate PDF: %s", invoice_number, e)
             return None
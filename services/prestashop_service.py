@@ -2,19 +2,213 @@
 Servicio para interactuar con la API de PrestaShop
 Obtiene pedidos pendientes de confirmación de factura
 """
+import asyncio
+import json
+import os
 import requests
 import xmltodict
 import logging
-from typing import List, Dict, Optional, Any
+import threading
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Dict, Optional, Any, Tuple
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+try:
+    from lxml import etree
+except ImportError:
+    # Sin lxml se usa xmltodict para parsear las respuestas
+    etree = None
 
 logger = logging.getLogger("ConfirmationInvoiceLogger")
 
+# Campo del pedido que el proceso espera como dict con la clave '_'
+SHIPPING_NUMBER = 'shipping_number'
+
+# Tamaño de los bloques de la respuesta de pedidos que se pasan al parser
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+# Peticiones simultáneas al obtener clientes en bloque
+CUSTOMER_FETCH_WORKERS = 8
+
+# Clientes guardados en memoria (se descartan primero los menos usados)
+CUSTOMER_CACHE_SIZE = 1024
+
+# Clientes con ETag guardados en disco para peticiones condicionales
+CUSTOMER_ETAG_CACHE_SIZE = 5000
+
+# Opciones de xmltodict: dict nativo en lugar de OrderedDict y sin expandir
+# namespaces. El agrupado de texto de Expat (buffer_text) ya lo activa
+# xmltodict internamente desde la versión 0.13.
+XML_PARSE_OPTIONS = {'dict_constructor': dict, 'process_namespaces': False}
+
+# Parser de lxml sin resolución de entidades (igual que xmltodict)
+_LXML_PARSER = etree.XMLParser(resolve_entities=False) if etree is not None else None
+
+# Plantillas del XML de order_histories (los valores se validan como enteros,
+# así que no necesitan escaparse)
+_ORDER_HISTORIES_OPEN = b"""<?xml version="1.0" encoding="UTF-8"?>
+<prestashop xmlns:xlink="http://www.w3.org/1999/xlink">"""
+_ORDER_HISTORY_TMPL = b"""
+    <order_history>
+        <id_order>%d</id_order>
+        <id_employee>%d</id_employee>
+        <id_order_state>%d</id_order_state>
+    </order_history>"""
+_ORDER_HISTORIES_CLOSE = b"""
+</prestashop>"""
+
+
+def _element_to_dict(elem) -> Any:
+    """
+    Convierte un elemento de lxml a la misma estructura que genera xmltodict.
+
+    Los atributos se guardan como '@prefijo:nombre', el texto junto a
+    atributos o hijos como '#text' y las etiquetas repetidas como listas.
+
+    Args:
+        elem: Elemento de lxml
+
+    Returns:
+        Dict con el contenido del elemento, o su texto si no tiene atributos ni hijos
+    """
+    result = {}
+
+    if elem.attrib:
+        prefixes = {uri: prefix for prefix, uri in elem.nsmap.items()}
+
+        for name, value in elem.attrib.items():
+            if name[0] == '{':
+                uri, local_name = name[1:].split('}', 1)
+                prefix = prefixes.get(uri)
+                name = f"{prefix}:{local_name}" if prefix else local_name
+            result['@' + name] = value
+
+    text_parts = [elem.text] if elem.text else []
+
+    for child in elem:
+        if child.tail:
+            text_parts.append(child.tail)
+
+        # Ignorar comentarios e instrucciones de procesamiento
+        if not isinstance(child.tag, str):
+            continue
+
+        value = _element_to_dict(child)
+        existing = result.get(child.tag)
+
+        if child.tag not in result:
+            result[child.tag] = value
+        elif isinstance(existing, list):
+            existing.append(value)
+        else:
+            result[child.tag] = [existing, value]
+
+    text = ''.join(text_parts).strip() or None
+
+    if not result:
+        return text
+
+    if text:
+        result['#text'] = text
+
+    return result
+
+
+def _order_fields_lxml(elem) -> Dict[str, Optional[str]]:
+    """
+    Obtiene el texto de los campos de primer nivel de un <order> de lxml.
+
+    Es la vista que recibe el filtro de pedidos: no recorre asociaciones ni
+    atributos, así que descartar un pedido no cuesta su conversión completa.
+
+    Args:
+        elem: Elemento <order> de lxml
+
+    Returns:
+        Diccionario campo -> texto (None si está vacío o solo tiene hijos)
+    """
+    return {
+        child.tag: (child.text or '').strip() or None
+        for child in elem
+        if isinstance(child.tag, str)
+    }
+
+
+def _order_fields_dict(order: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    """
+    Obtiene la misma vista que _order_fields_lxml a partir de un pedido ya parseado.
+
+    Args:
+        order: Pedido en el formato de xmltodict
+
+    Returns:
+        Diccionario campo -> texto (None si está vacío o solo tiene hijos)
+    """
+    fields = {}
+
+    for name, value in order.items():
+        if name[0] in '@#':
+            continue
+        if isinstance(value, dict):
+            value = value.get('#text')
+        fields[name] = value if isinstance(value, str) else None
+
+    return fields
+
+
+def get_customer_url(order: Dict[str, Any]) -> Optional[str]:
+    """
+    Obtiene la URL del recurso del cliente de un pedido.
+
+    Args:
+        order: Pedido de PrestaShop
+
+    Returns:
+        URL del cliente (xlink:href), None si el pedido no la incluye
+    """
+    id_customer = order.get('id_customer')
+
+    if isinstance(id_customer, dict):
+        return id_customer.get('@xlink:href')
+
+    return None
+
+
+def _parse_customer_lxml(content: bytes) -> Dict[str, Optional[str]]:
+    """
+    Extrae con lxml solo los campos del cliente que se usan en el proceso.
+
+    Args:
+        content: Respuesta XML del recurso customer
+
+    Returns:
+        Dict con id, firstname, lastname y email (None si no existen)
+    """
+    root = etree.fromstring(content, _LXML_PARSER)
+
+    return {
+        name: root.findtext(f'customer/{name}') or None
+        for name in ('id', 'firstname', 'lastname', 'email')
+    }
+
 
 class PrestaShopService:
     """Maneja operaciones con la API de PrestaShop"""
 
-    def __init__(self, api_url: str, username: str, password: str = ""):
+    def __init__(
+        self,
+        api_url: str,
+        username: str,
+        password: str = "",
+        use_lxml: bool = True,
+        order_fields: Optional[List[str]] = None,
+        customer_cache_file: Optional[str] = None,
+        bulk_state_updates: bool = False
+    ):
         """
         Inicializa el servicio de PrestaShop.
 
@@ -22,15 +216,99 @@ class PrestaShopService:
             api_url: URL base de la API de PrestaShop
             username: Usuario para autenticación (API Key)
             password: Contraseña (vacío para PrestaShop)
+            use_lxml: Parsear las respuestas con lxml (si está instalado) en lugar de xmltodict
+            order_fields: Campos de pedido a solicitar (None o vacío para todos)
+            customer_cache_file: Archivo JSON con los clientes y su ETag entre ejecuciones (None para desactivarlo)
+            bulk_state_updates: Enviar los cambios de estado en un único POST (solo si el
+                webservice crea varios order_history por petición)
         """
         self.api_url = api_url.rstrip('/')
+        self.use_lxml = use_lxml and etree is not None
+        self.bulk_state_updates = bulk_state_updates
+
+        # Proyección de campos del listado de pedidos: display=[campo1,campo2,...]
+        fields = [field.strip() for field in order_fields or [] if field.strip()]
+        self.order_display = f"[{','.join(fields)}]" if fields else "full"
         self.auth = HTTPBasicAuth(username, password)
         self.session = requests.Session()
         self.session.auth = self.auth
+        self._customer_cache: "OrderedDict[str, Dict]" = OrderedDict()
+        self._customer_cache_lock = threading.Lock()
+        self.customer_cache_file = customer_cache_file or None
+        self._etag_cache: "OrderedDict[str, Dict]" = self._load_etag_cache()
+        self._etag_cache_dirty = False
+
+        # Conexiones persistentes al mismo host y reintentos ante errores transitorios
+        # del servidor (Retry no reintenta POST por defecto: crear un historial no es
+        # idempotente)
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504))
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Connection'] = 'keep-alive'
+        self.session.headers['Accept-Encoding'] = 'gzip'
 
         logger.info("PrestaShop Service initialized")
 
-    def get_orders_pending_invoice(self) -> List[Dict[str, Any]]:
+    def _load_etag_cache(self) -> "OrderedDict[str, Dict]":
+        """
+        Carga del disco los clientes guardados con su ETag.
+
+        Returns:
+            Diccionario URL del cliente -> {'etag', 'customer'} (vacío si no hay archivo)
+        """
+        if not self.customer_cache_file or not os.path.exists(self.customer_cache_file):
+            return OrderedDict()
+
+        try:
+            with open(self.customer_cache_file, 'r', encoding='utf-8') as cache_file:
+                entries = json.load(cache_file)
+
+            logger.debug(f"Loaded {len(entries)} customers from {self.customer_cache_file}")
+            return OrderedDict(entries)
+
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load customer cache, starting empty: {e}")
+            return OrderedDict()
+
+    def save_customer_cache(self):
+        """Guarda en disco los clientes con ETag si han cambiado en esta ejecución."""
+        if not self.customer_cache_file:
+            return
+
+        with self._customer_cache_lock:
+            if not self._etag_cache_dirty:
+                return
+
+            while len(self._etag_cache) > CUSTOMER_ETAG_CACHE_SIZE:
+                self._etag_cache.popitem(last=False)
+
+            entries = dict(self._etag_cache)
+            self._etag_cache_dirty = False
+
+        try:
+            directory = os.path.dirname(self.customer_cache_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            # Escribir en un archivo temporal y reemplazar, para no dejarlo a medias
+            temp_file = f"{self.customer_cache_file}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as cache_file:
+                json.dump(entries, cache_file, ensure_ascii=False)
+            os.replace(temp_file, self.customer_cache_file)
+
+            logger.debug(f"Saved {len(entries)} customers to {self.customer_cache_file}")
+
+        except OSError as e:
+            logger.warning(f"Could not save customer cache: {e}")
+
+    def get_orders_pending_invoice(
+        self,
+        predicate: Optional[Callable[[Dict[str, Optional[str]]], bool]] = None
+    ) -> List[Dict[str, Any]]:
         """
         Obtiene pedidos en estado 4 (pendientes de factura) con pagos confirmados.
 
@@ -38,6 +316,11 @@ class PrestaShopService:
         - payment: PayPal, Redsys, PayPal with fee, Pagos por transferencia bancaria
         - current_state: 4 (Preparación en curso)
 
+        Args:
+            predicate: Filtro opcional que recibe los campos de primer nivel del
+                pedido (nombre -> texto) y devuelve False para descartarlo. Con
+                lxml se evalúa antes de convertir el pedido a dict
+
         Returns:
             Lista de pedidos en formato dict
         """
@@ -46,31 +329,26 @@ class PrestaShopService:
             filters = {
                 "filter[payment]": "[PayPal|Redsys|PayPal with fee|Pagos por transferencia bancaria]",
                 "filter[current_state]": "[4]",
-                "display": "full"
+                "display": self.order_display
             }
 
             url = f"{self.api_url}/orders"
 
             logger.info(f"Fetching orders from PrestaShop API: {url}")
 
-            response = self.session.get(url, params=filters, timeout=30)
-            response.raise_for_status()
-
-            # Log del contenido de la respuesta para debugging
-            logger.debug(f"Response status: {response.status_code}")
-            logger.debug(f"Response length: {len(response.content)} bytes")
+            with self.session.get(url, params=filters, timeout=30, stream=True) as response:
+                response.raise_for_status()
 
-            # Parsear XML a dict
-            data = xmltodict.parse(response.content)
+                logger.debug(f"Response status: {response.status_code}")
 
-            # Log de la estructura de datos para debugging
-            if data:
-                logger.debug(f"Parsed data keys: {list(data.keys())}")
-                if 'prestashop' in data and data['prestashop']:
-                    logger.debug(f"Prestashop keys: {list(data['prestashop'].keys())}")
+                # Parsear el XML según llegan los bloques (ya descomprimidos),
+                # solapando la descarga con el parseo
+                chunks = response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE)
 
-            # Normalizar la estructura de orders
-            orders = self._normalize_orders(data)
+                if self.use_lxml:
+                    orders = self._parse_orders_lxml(chunks, predicate)
+                else:
+                    orders = self._parse_orders_xmltodict(chunks, predicate)
 
             logger.info(f"Found {len(orders)} pending orders")
             return orders
@@ -82,50 +360,103 @@ class PrestaShopService:
             logger.error(f"Unexpected error parsing orders: {e}")
             raise
 
-    def _normalize_orders(self, data: Dict) -> List[Dict]:
+    def _parse_orders_lxml(self, chunks: Iterable[bytes], predicate: Optional[Callable] = None) -> List[Dict]:
         """
-        Normaliza la estructura de órdenes que puede venir en diferentes formatos.
+        Parsea la lista de pedidos con lxml.etree.XMLPullParser.
+
+        Cada <order> se convierte a dict al cerrarse y después se libera del
+        árbol, de modo que la memoria no crece con el tamaño de la respuesta.
 
         Args:
-            data: Datos parseados del XML
+            chunks: Bloques de la respuesta XML
+            predicate: Filtro opcional sobre los campos de primer nivel del pedido
 
         Returns:
             Lista normalizada de pedidos
         """
-        # Verificar que data y prestashop no sean None
-        if not data:
-            logger.warning("Empty data received from PrestaShop API")
-            return []
+        orders = []
+        append_order = orders.append
+        normalize_order = self._normalize_order
+        parser = etree.XMLPullParser(events=('end',), tag='order', resolve_entities=False)
+
+        def collect_orders():
+            for _, elem in parser.read_events():
+                parent = elem.getparent()
+
+                if parent is None or parent.tag != 'orders':
+                    continue
+
+                if predicate is None or predicate(_order_fields_lxml(elem)):
+                    append_order(normalize_order(_element_to_dict(elem) or {}))
+
+                # Liberar el pedido ya convertido y los anteriores
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+        for chunk in chunks:
+            parser.feed(chunk)
+            collect_orders()
+
+        parser.close()
+        collect_orders()
+
+        return orders
+
+    def _parse_orders_xmltodict(self, chunks: Iterable[bytes], predicate: Optional[Callable] = None) -> List[Dict]:
+        """
+        Parsea la lista de pedidos con xmltodict en modo streaming.
 
-        prestashop = data.get('prestashop')
-        if not prestashop:
-            logger.warning("No 'prestashop' key in API response")
-            return []
+        Args:
+            chunks: Bloques de la respuesta XML
+            predicate: Filtro opcional sobre los campos de primer nivel del pedido
 
+        Returns:
+            Lista normalizada de pedidos
+        """
         orders = []
+        append_order = orders.append
+        normalize_order = self._normalize_order
+
+        def collect_order(path, order):
+            # Cada <order> de prestashop > orders se normaliza según se emite
+            if path[-2][0] == 'orders' and path[-1][0] == 'order':
+                order = order or {}
+                if predicate is None or predicate(_order_fields_dict(order)):
+                    append_order(normalize_order(order))
+            return True
 
-        # Verificar si hay órdenes
-        if prestashop.get('orders') and prestashop['orders'].get('order'):
-            order_data = prestashop['orders']['order']
-
-            # Si es un solo pedido, convertir a lista
-            if isinstance(order_data, dict):
-                orders = [order_data]
-            elif isinstance(order_data, list):
-                orders = order_data
-        elif prestashop.get('order'):
-            # Orden directa
-            orders = [prestashop['order']]
-
-        # Asegurar que el campo shipping_number existe
-        for order in orders:
-            if 'shipping_number' not in order or order['shipping_number'] is None:
-                order['shipping_number'] = {'_': ''}
-            elif isinstance(order['shipping_number'], dict) and '_' not in order['shipping_number']:
-                order['shipping_number']['_'] = ''
+        # xmltodict solo alimenta Expat bloque a bloque si recibe un generador
+        xmltodict.parse(
+            (chunk for chunk in chunks),
+            item_depth=3,
+            item_callback=collect_order,
+            **XML_PARSE_OPTIONS
+        )
 
         return orders
 
+    @staticmethod
+    def _normalize_order(order: Dict) -> Dict:
+        """
+        Asegura que el pedido tiene el campo shipping_number con la clave '_'.
+
+        Args:
+            order: Pedido parseado del XML
+
+        Returns:
+            El mismo pedido normalizado
+        """
+        shipping_number = order.get(SHIPPING_NUMBER)
+
+        if shipping_number is None:
+            # Dict nuevo en cada pedido: uno compartido se modificaría desde cualquiera de ellos
+            order[SHIPPING_NUMBER] = {'_': ''}
+        elif type(shipping_number) is dict and '_' not in shipping_number:
+            shipping_number['_'] = ''
+
+        return order
+
     def get_customer_data(self, customer_url: str) -> Optional[Dict]:
         """
         Obtiene información del cliente desde su URL.
@@ -136,27 +467,106 @@ class PrestaShopService:
         Returns:
             Información del cliente
         """
+        with self._customer_cache_lock:
+            cached = self._customer_cache.get(customer_url)
+            if cached is not None:
+                self._customer_cache.move_to_end(customer_url)
+                return cached
+
+        with self._customer_cache_lock:
+            stored = self._etag_cache.get(customer_url)
+
         try:
             logger.debug(f"Fetching customer data from: {customer_url}")
 
-            response = self.session.get(customer_url, timeout=30)
-            response.raise_for_status()
+            # Petición condicional: si el cliente no ha cambiado se reutiliza el guardado
+            headers = {'If-None-Match': stored['etag']} if stored else None
 
-            data = xmltodict.parse(response.content)
+            response = self.session.get(customer_url, headers=headers, timeout=30)
 
-            customer = data.get('prestashop', {}).get('customer', {})
+            if response.status_code == 304 and stored:
+                logger.debug(f"Customer not modified: {customer_url}")
+                return self._store_customer(customer_url, dict(stored['customer']))
 
-            return {
+            response.raise_for_status()
+
+            if self.use_lxml:
+                customer = _parse_customer_lxml(response.content)
+            else:
+                data = xmltodict.parse(response.content, **XML_PARSE_OPTIONS)
+                customer = data.get('prestashop', {}).get('customer', {})
+
+            customer_data = {
                 'id': customer.get('id'),
                 'firstname': customer.get('firstname'),
                 'lastname': customer.get('lastname'),
                 'email': customer.get('email')
             }
 
+            return self._store_customer(customer_url, customer_data, response.headers.get('ETag'))
+
         except Exception as e:
             logger.error(f"Error fetching customer data: {e}")
             return None
 
+    def _store_customer(self, customer_url: str, customer_data: Dict, etag: Optional[str] = None) -> Dict:
+        """
+        Guarda un cliente en la caché en memoria y, si hay ETag, en la de disco.
+
+        Args:
+            customer_url: URL del recurso del cliente
+            customer_data: Datos del cliente
+            etag: ETag de la respuesta (None si no se recibió o no cambió)
+
+        Returns:
+            Los mismos datos del cliente
+        """
+        with self._customer_cache_lock:
+            self._customer_cache[customer_url] = customer_data
+            if len(self._customer_cache) > CUSTOMER_CACHE_SIZE:
+                self._customer_cache.popitem(last=False)
+
+            if self.customer_cache_file:
+                if etag:
+                    self._etag_cache[customer_url] = {'etag': etag, 'customer': customer_data}
+                    self._etag_cache_dirty = True
+                if customer_url in self._etag_cache:
+                    self._etag_cache.move_to_end(customer_url)
+
+        return customer_data
+
+    def clear_customer_cache(self):
+        """Vacía la caché de clientes."""
+        with self._customer_cache_lock:
+            self._customer_cache.clear()
+
+    def get_customers_bulk(self, customer_urls: List[str]) -> Dict[str, Dict]:
+        """
+        Obtiene varios clientes en paralelo, reutilizando las conexiones de la sesión.
+
+        Args:
+            customer_urls: URLs de los recursos de cliente (xlink:href)
+
+        Returns:
+            Diccionario URL -> datos del cliente (solo los obtenidos correctamente)
+        """
+        unique_urls = list(dict.fromkeys(url for url in customer_urls if url))
+
+        if not unique_urls:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=CUSTOMER_FETCH_WORKERS) as executor:
+            results = list(executor.map(self.get_customer_data, unique_urls))
+
+        customers = {url: data for url, data in zip(unique_urls, results) if data}
+
+        logger.info(f"Fetched {len(customers)}/{len(unique_urls)} customers from PrestaShop")
+        return customers
+
+    async def get_customers_bulk_async(self, customer_urls: List[str]) -> Dict[str, Dict]:
+        """Versión asíncrona de get_customers_bulk, ejecutada en un hilo."""
+        return await asyncio.to_thread(self.get_customers_bulk, customer_urls)
+
     def update_order_state(self, order_id: str, new_state_id: int = 23, employee_id: int = 5) -> bool:
         """
         Actualiza el estado del pedido.
@@ -170,31 +580,15 @@ class PrestaShopService:
             True si se actualizó correctamente
         """
         try:
-            url = f"{self.api_url}/order_histories"
-
-            # Crear XML para actualizar el estado
-            xml_data = f"""<?xml version="1.0" encoding="UTF-8"?>
-<prestashop xmlns:xlink="http://www.w3.org/1999/xlink">
-    <order_history>
-        <id_order>{order_id}</id_order>
-        <id_employee>{employee_id}</id_employee>
-        <id_order_state>{new_state_id}</id_order_state>
-    </order_history>
-</prestashop>"""
-
-            headers = {
-                'Content-Type': 'application/xml'
-            }
+            order_number, state_number, employee_number = int(order_id), int(new_state_id), int(employee_id)
+        except (TypeError, ValueError):
+            logger.error(f"Invalid order state update: order {order_id}, state {new_state_id}")
+            return False
 
+        try:
             logger.info(f"Updating order {order_id} to state {new_state_id}")
 
-            response = self.session.post(
-                url,
-                data=xml_data.encode('utf-8'),
-                headers=headers,
-                timeout=30
-            )
-            response.raise_for_status()
+            self._post_order_histories([(order_number, state_number)], employee_number)
 
             logger.info(f"Order {order_id} state updated successfully")
             return True
@@ -203,6 +597,149 @@ class PrestaShopService:
             logger.error(f"Error updating order state: {e}")
             return False
 
+    def update_order_states_bulk(self, updates: List[Tuple[str, int]], employee_id: int = 5) -> Dict[str, bool]:
+        """
+        Actualiza el estado de varios pedidos.
+
+        Sin bulk_state_updates se hace un POST por pedido. Con él se envía un
+        único POST con todos los order_history; PrestaShop estándar solo crea
+        el primero, así que los pedidos que la respuesta no confirma (o todos,
+        si el servidor rechaza el envío) se actualizan después uno a uno. Si
+        la respuesta es correcta pero no se puede leer, no se reintenta nada
+        para no duplicar historiales y esos pedidos se dan como no actualizados.
+
+        Args:
+            updates: Tuplas (ID del pedido, ID del nuevo estado)
+            employee_id: ID del empleado que hace el cambio
+
+        Returns:
+            Diccionario ID del pedido -> True si se actualizó correctamente
+        """
+        results = {str(order_id): False for order_id, _ in updates}
+
+        if not self.bulk_state_updates or len(updates) < 2:
+            for order_id, new_state_id in updates:
+                results[str(order_id)] = self.update_order_state(order_id, new_state_id, employee_id)
+            return results
+
+        histories = []
+
+        for order_id, new_state_id in updates:
+            try:
+                histories.append((str(order_id), int(order_id), int(new_state_id)))
+            except (TypeError, ValueError):
+                logger.error(f"Invalid order state update: order {order_id}, state {new_state_id}")
+
+        if not histories:
+            return results
+
+        try:
+            logger.info(f"Updating state of {len(histories)} orders")
+
+            response = self._post_order_histories(
+                [(order_number, new_state_id) for _, order_number, new_state_id in histories],
+                int(employee_id)
+            )
+            confirmed = self._parse_order_history_ids(response.content)
+
+            if confirmed is None:
+                # El servidor aceptó el envío pero no se sabe qué creó
+                logger.error("Unreadable bulk order state response, orders not retried")
+                return results
+
+        except requests.exceptions.HTTPError as e:
+            # El servidor respondió con error: no se creó ningún historial
+            logger.warning(f"Bulk order state update rejected, updating one by one: {e}")
+            confirmed = set()
+
+        except Exception as e:
+            # Sin respuesta no se sabe qué se creó; no se reintenta para no duplicar historiales
+            logger.error(f"Error updating order states: {e}")
+            return results
+
+        for order_id, order_number, new_state_id in histories:
+            if str(order_number) in confirmed:
+                results[order_id] = True
+                logger.info(f"Order {order_id} state updated successfully")
+            else:
+                results[order_id] = self.update_order_state(order_id, new_state_id, employee_id)
+
+        return results
+
+    def _post_order_histories(self, histories: List[Tuple[int, int]], employee_number: int) -> requests.Response:
+        """
+        Envía un POST a order_histories con un order_history por pedido.
+
+        Args:
+            histories: Tuplas (ID del pedido, ID del nuevo estado) ya validadas como enteros
+            employee_number: ID del empleado que hace el cambio
+
+        Returns:
+            Respuesta del servidor (lanza HTTPError si no es correcta)
+        """
+        xml_data = b''.join((
+            _ORDER_HISTORIES_OPEN,
+            *(
+                _ORDER_HISTORY_TMPL % (order_number, employee_number, new_state_id)
+                for order_number, new_state_id in histories
+            ),
+            _ORDER_HISTORIES_CLOSE
+        ))
+
+        headers = {
+            'Content-Type': 'application/xml'
+        }
+
+        response = self.session.post(
+            f"{self.api_url}/order_histories",
+            data=xml_data,
+            headers=headers,
+            timeout=30
+        )
+        response.raise_for_status()
+
+        return response
+
+    async def update_order_states_bulk_async(
+        self,
+        updates: List[Tuple[str, int]],
+        employee_id: int = 5
+    ) -> Dict[str, bool]:
+        """Versión asíncrona de update_order_states_bulk, ejecutada en un hilo."""
+        return await asyncio.to_thread(self.update_order_states_bulk, updates, employee_id)
+
+    def _parse_order_history_ids(self, content: bytes) -> Optional[set]:
+        """
+        Obtiene los IDs de pedido de los order_history devueltos por el servidor.
+
+        Args:
+            content: Respuesta XML del POST a order_histories
+
+        Returns:
+            Conjunto de IDs de pedido confirmados, None si la respuesta no se puede leer
+        """
+        try:
+            if self.use_lxml:
+                root = etree.fromstring(content, _LXML_PARSER)
+                return {
+                    history.findtext('id_order').strip()
+                    for history in root.iterfind('order_history')
+                    if history.findtext('id_order')
+                }
+
+            # Respuesta de forma conocida: basta con ElementTree, sin pasar por xmltodict
+            root = ElementTree.fromstring(content)
+            return {
+                history.findtext('id_order').strip()
+                for history in root.iterfind('order_history')
+                if history.findtext('id_order')
+            }
+
+        except Exception as e:
+            logger.warning(f"Could not parse order history response: {e}")
+            return None
+
     def close(self):
-        """Cierra la sesión HTTP."""
+        """Guarda la caché de clientes en disco y cierra la sesión HTTP."""
+        self.save_customer_cache()
         self.session.close()
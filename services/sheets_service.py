@@ -2,17 +2,48 @@
 Servicio para interactuar con Google Sheets
 Registra las facturas enviadas en una hoja de cálculo
 """
+import asyncio
 import logging
-from typing import Dict, List, Optional
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
+from urllib.parse import quote
+import requests
+from google.auth.exceptions import GoogleAuthError
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger("ConfirmationInvoiceLogger")
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
+# Endpoint REST de Sheets
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+
+# Filas de un rango A1 devuelto por la API (ej: "Facturas!A12:D14")
+UPDATED_RANGE_ROWS = re.compile(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?$")
+
+
+def _updated_rows(updated_range: str) -> Optional[Tuple[int, int]]:
+    """
+    Obtiene la primera y última fila de un rango escrito por la API.
+
+    Args:
+        updated_range: Rango en notación A1 (ej: "Facturas!A12:D14")
+
+    Returns:
+        Tupla (primera fila, última fila), None si el rango no es reconocible
+    """
+    match = UPDATED_RANGE_ROWS.search(updated_range or '')
+
+    if not match:
+        return None
+
+    first = int(match.group(1))
+    return first, int(match.group(2) or first)
+
 
 class SheetsService:
     """Maneja operaciones con Google Sheets usando Service Account"""
@@ -26,10 +57,16 @@ class SheetsService:
             spreadsheet_id: ID de la hoja de cálculo
             sheet_name: Nombre de la hoja dentro del spreadsheet
         """
-        self.service = None
         self.spreadsheet_id = spreadsheet_id
         self.sheet_name = sheet_name
         self.credentials_file = credentials_file
+        self._session: Optional[AuthorizedSession] = None
+        self._ref_index: Optional[Dict[str, int]] = None
+        self._ref_index_rows = 0
+        self._ref_values: Dict[str, Tuple[str, str]] = {}
+        self._pending: List[Tuple[str, str, str]] = []
+        self._pending_lock = threading.Lock()
+        self._run_timestamp: Optional[str] = None
         self._authenticate()
 
     def _authenticate(self):
@@ -40,16 +77,125 @@ class SheetsService:
                 scopes=SCOPES
             )
 
-            self.service = build('sheets', 'v4', credentials=creds)
+            # Sesión compartida entre hilos para todas las llamadas REST a Sheets
+            self._session = AuthorizedSession(creds)
+            self._session.mount('https://', HTTPAdapter(pool_maxsize=8))
+
             logger.info("✅ Google Sheets Service authenticated successfully")
 
         except Exception as e:
             logger.error(f"❌ Error authenticating with Google Sheets: {str(e)}")
-            self.service = None
+            self._session = None
+
+    def _values_request(self, method: str, path: str, **kwargs) -> Dict:
+        """
+        Llama a spreadsheets.values por REST con la sesión compartida.
+
+        Args:
+            method: Método HTTP
+            path: Ruta tras /values (ej: "/Facturas!A:A" o ":batchUpdate")
+            **kwargs: Argumentos de requests (params, json)
+
+        Returns:
+            Respuesta JSON de la API
+        """
+        response = self._session.request(
+            method,
+            f"{SHEETS_API_URL}/{self.spreadsheet_id}/values{path}",
+            timeout=60,
+            **kwargs
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def _get_ref_index(self) -> Optional[Dict[str, int]]:
+        """
+        Devuelve el índice nombre de archivo -> fila, leyendo la hoja solo la primera vez.
+
+        Junto al índice se guardan el ID y el número de factura de cada fila
+        (columnas B y C) para no reescribir registros que no han cambiado.
+
+        Returns:
+            Índice de referencias, None si no se pudo leer la hoja
+        """
+        if self._ref_index is not None:
+            return self._ref_index
+
+        try:
+            result = self._values_request('GET', '/' + quote(f"{self.sheet_name}!A:C", safe=''))
+
+            values = result.get('values', [])
+            index = {}
+            ref_values = {}
+
+            for idx, row in enumerate(values, start=1):
+                if row and row[0] and row[0] not in index:
+                    # Conservar la primera aparición, igual que la búsqueda secuencial
+                    index[row[0]] = idx
+                    ref_values[row[0]] = (
+                        row[1] if len(row) > 1 else '',
+                        row[2] if len(row) > 2 else ''
+                    )
+
+            self._ref_index = index
+            self._ref_index_rows = len(values)
+            self._ref_values = ref_values
+
+            logger.debug(f"Loaded Sheets reference index ({len(index)} rows)")
+            return index
+
+        except (requests.exceptions.RequestException, GoogleAuthError) as e:
+            logger.error(f"Error loading references from Sheets: {e}")
+            return None
+
+    def _index_appended_rows(self, new_rows: Dict[str, List], updated_range: str):
+        """
+        Añade al índice las filas recién escritas por values.append.
+
+        Si las filas no siguen a las ya conocidas (la hoja cambió por otro
+        lado), el índice se descarta y se vuelve a leer en el siguiente uso.
+
+        Args:
+            new_rows: Nombre de archivo -> valores de la fila añadida, en orden
+            updated_range: Rango escrito según la respuesta de la API
+        """
+        if self._ref_index is None:
+            return
+
+        rows = _updated_rows(updated_range)
+
+        if (
+            rows is None
+            or rows[0] != self._ref_index_rows + 1
+            or rows[1] - rows[0] + 1 != len(new_rows)
+        ):
+            logger.debug(f"Unexpected appended range {updated_range}, reloading Sheets reference index")
+            self._ref_index = None
+            return
+
+        for row_number, (file_name, values) in enumerate(new_rows.items(), start=rows[0]):
+            self._ref_index.setdefault(file_name, row_number)
+            self._ref_values[file_name] = (str(values[1]), str(values[2]))
+
+        self._ref_index_rows = rows[1]
+
+    def begin_run(self):
+        """Inicia una ejecución: los registros siguientes tendrán una nueva fecha de envío."""
+        self._run_timestamp = None
+
+    def _get_timestamp(self) -> str:
+        """Devuelve la fecha de envío de la ejecución actual, calculada una sola vez."""
+        if self._run_timestamp is None:
+            self._run_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M')
+
+        return self._run_timestamp
 
     def append_or_update_invoice(self, reference: str, invoice_id: str, invoice_number: str) -> bool:
         """
-        Añade o actualiza un registro de factura enviada en la hoja.
+        Encola un registro de factura enviada para añadirlo o actualizarlo en la hoja.
+
+        Los registros se escriben todos juntos con flush_pending_invoices()
+        (o al cerrar el servicio).
 
         Args:
             reference: Referencia del pedido (ej: ABCDEFGH)
@@ -57,107 +203,133 @@ class SheetsService:
             invoice_number: Número de factura (ej: 2024-0001)
 
         Returns:
-            True si la operación fue exitosa
+            True si el registro quedó encolado
         """
-        if not self.service:
+        if self._session is None:
             logger.error("Google Sheets service not available")
             return False
 
-        try:
-            # Preparar datos
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M')
-            file_name = f"factura_{reference}.json"
-
-            # Buscar si ya existe la referencia
-            existing_row = self._find_row_by_reference(reference)
+        with self._pending_lock:
+            self._pending.append((reference, invoice_id, invoice_number))
 
-            if existing_row is not None:
-                # Actualizar fila existente
-                return self._update_row(existing_row, file_name, invoice_id, invoice_number, timestamp)
-            else:
-                # Añadir nueva fila
-                return self._append_row(file_name, invoice_id, invoice_number, timestamp)
+        return True
 
-        except Exception as e:
-            logger.error(f"Error appending/updating invoice in Sheets: {e}")
-            return False
-
-    def _find_row_by_reference(self, reference: str) -> Optional[int]:
+    def flush_pending_invoices(self) -> bool:
         """
-        Busca la fila que contiene una referencia específica.
+        Escribe en la hoja todos los registros encolados con batch_append_or_update.
 
-        Args:
-            reference: Referencia a buscar
+        Si la escritura falla, los registros vuelven a la cola.
 
         Returns:
-            Número de fila (índice base 1) o None si no existe
+            True si la operación fue exitosa (o no había nada pendiente)
         """
-        try:
-            file_name = f"factura_{reference}.json"
-            range_name = f"{self.sheet_name}!A:A"
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
 
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=self.spreadsheet_id,
-                range=range_name
-            ).execute()
+        if not pending:
+            return True
 
-            values = result.get('values', [])
+        saved = False
 
-            for idx, row in enumerate(values, start=1):
-                if row and row[0] == file_name:
-                    logger.debug(f"Reference found in row {idx}")
-                    return idx
+        try:
+            saved = self.batch_append_or_update(pending)
+        finally:
+            if not saved:
+                with self._pending_lock:
+                    self._pending[:0] = pending
 
-            return None
+        return saved
 
-        except HttpError as e:
-            logger.error(f"Error finding row by reference: {e}")
-            return None
+    async def flush_pending_invoices_async(self) -> bool:
+        """Versión asíncrona de flush_pending_invoices, ejecutada en un hilo."""
+        return await asyncio.to_thread(self.flush_pending_invoices)
 
-    def _update_row(self, row_number: int, file_name: str, invoice_id: str, invoice_number: str, timestamp: str) -> bool:
-        """Actualiza una fila existente."""
-        try:
-            range_name = f"{self.sheet_name}!A{row_number}:D{row_number}"
-            values = [[file_name, invoice_id, invoice_number, timestamp]]
+    def batch_append_or_update(self, invoices: List[Tuple[str, str, str]]) -> bool:
+        """
+        Añade o actualiza varios registros de factura con el mínimo de llamadas.
 
-            body = {'values': values}
+        Lee la hoja una sola vez, actualiza las filas existentes con un
+        único values.batchUpdate y añade las nuevas con un único values.append
+        (batchUpdate no puede escribir fuera de los límites de la hoja). Las
+        filas que ya tienen el mismo ID y número de factura no se reescriben.
 
-            self.service.spreadsheets().values().update(
-                spreadsheetId=self.spreadsheet_id,
-                range=range_name,
-                valueInputOption='RAW',
-                body=body
-            ).execute()
+        Args:
+            invoices: Tuplas (referencia, ID de factura, número de factura)
 
-            logger.info(f"✅ Updated invoice record in Sheets (row {row_number}): {invoice_number}")
+        Returns:
+            True si la operación fue exitosa
+        """
+        if not invoices:
             return True
 
-        except HttpError as e:
-            logger.error(f"Error updating row in Sheets: {e}")
+        if self._session is None:
+            logger.error("Google Sheets service not available")
             return False
 
-    def _append_row(self, file_name: str, invoice_id: str, invoice_number: str, timestamp: str) -> bool:
-        """Añade una nueva fila."""
         try:
-            range_name = f"{self.sheet_name}!A:D"
-            values = [[file_name, invoice_id, invoice_number, timestamp]]
+            timestamp = self._get_timestamp()
+            existing_rows = self._get_ref_index()
+
+            if existing_rows is None:
+                return False
+
+            updates = []
+            updated_values = {}
+            new_rows = {}
+            unchanged = 0
+
+            for reference, invoice_id, invoice_number in invoices:
+                file_name = f"factura_{reference}.json"
+                values = [file_name, invoice_id, invoice_number, timestamp]
+                row_number = existing_rows.get(file_name)
+
+                if row_number is None:
+                    new_rows[file_name] = values
+                elif self._ref_values.get(file_name) == (str(invoice_id), str(invoice_number)):
+                    # Mismo registro ya guardado: solo cambiaría la fecha
+                    unchanged += 1
+                else:
+                    updates.append({
+                        'range': f"{self.sheet_name}!A{row_number}:D{row_number}",
+                        'values': [values]
+                    })
+                    updated_values[file_name] = (str(invoice_id), str(invoice_number))
+
+            if updates:
+                self._values_request(
+                    'POST', ':batchUpdate',
+                    json={'valueInputOption': 'RAW', 'data': updates}
+                )
+                self._ref_values.update(updated_values)
+
+            if new_rows:
+                result = self._values_request(
+                    'POST', '/' + quote(f"{self.sheet_name}!A:D", safe='') + ':append',
+                    params={'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'},
+                    json={'values': list(new_rows.values())}
+                )
+
+                self._index_appended_rows(new_rows, result.get('updates', {}).get('updatedRange', ''))
+
+            logger.info(
+                f"✅ Saved invoice records to Sheets "
+                f"({len(updates)} updated, {len(new_rows)} appended, {unchanged} unchanged)"
+            )
+            return True
 
-            body = {'values': values}
+        except (requests.exceptions.RequestException, GoogleAuthError) as e:
+            logger.error(f"Error saving invoice records to Sheets: {e}")
+            return False
 
-            self.service.spreadsheets().values().append(
-                spreadsheetId=self.spreadsheet_id,
-                range=range_name,
-                valueInputOption='RAW',
-                insertDataOption='INSERT_ROWS',
-                body=body
-            ).execute()
+    def close(self):
+        """Escribe los registros que queden encolados y cierra la sesión HTTP."""
+        if self._pending:
+            self.flush_pending_invoices()
 
-            logger.info(f"✅ Appended invoice record to Sheets: {invoice_number}")
-            return True
+        self._run_timestamp = None
 
-        except HttpError as e:
-            logger.error(f"Error appending row to Sheets: {e}")
-            return False
+        if self._session is not None:
+            self._session.close()
 
     def get_all_invoices(self) -> List[Dict[str, str]]:
         """
@@ -166,17 +338,14 @@ class SheetsService:
         Returns:
             Lista de diccionarios con los datos de las facturas
         """
-        if not self.service:
+        if self._session is None:
             logger.error("Google Sheets service not available")
             return []
 
         try:
             range_name = f"{self.sheet_name}!A:D"
 
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=self.spreadsheet_id,
-                range=range_name
-            ).execute()
+            result = self._values_request('GET', '/' + quote(range_name, safe=''))
 
             values = result.get('values', [])
 
@@ -199,6 +368,6 @@ class SheetsService:
             logger.info(f"Retrieved {len(invoices)} invoice records from Sheets")
             return invoices
 
-        except HttpError as e:
+        except (requests.exceptions.RequestException, GoogleAuthError) as e:
             logger.error(f"Error getting invoices from Sheets: {e}")
             return []